@@ -6,15 +6,18 @@
 import os
 import sys
 
-from diff_lib import get_cmd_output, checkout_commit_and_generate
+from diff_lib import get_cmd_output, checkout_commit_and_generate, stop_gradle_daemon
 
 
 def main():
     repository_root = sys.argv[1]
     os.chdir(repository_root)
     (_, head_commit_sha, _) = get_cmd_output("git rev-parse HEAD")
-    checkout_commit_and_generate(head_commit_sha, targets=['aws:sdk'], branch_name='once')
-    checkout_commit_and_generate(head_commit_sha, targets=['aws:sdk'], branch_name='twice')
+    try:
+        checkout_commit_and_generate(head_commit_sha, targets=['aws:sdk'], branch_name='once')
+        checkout_commit_and_generate(head_commit_sha, targets=['aws:sdk'], branch_name='twice')
+    finally:
+        stop_gradle_daemon()
     get_cmd_output('git diff once..twice --exit-code')
 
 
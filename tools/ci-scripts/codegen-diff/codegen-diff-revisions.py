@@ -7,7 +7,7 @@ import os
 import sys
 
 from diff_lib import eprint, run, get_cmd_status, get_cmd_output, generate_and_commit_generated_code, make_diffs, \
-    write_to_file, HEAD_BRANCH_NAME, BASE_BRANCH_NAME, OUTPUT_PATH, running_in_docker_build
+    write_to_file, stop_gradle_daemon, HEAD_BRANCH_NAME, BASE_BRANCH_NAME, OUTPUT_PATH, running_in_docker_build
 
 
 # This script can be run and tested locally. To do so, you should check out
@@ -51,17 +51,24 @@ def main():
 
     if running_in_docker_build():
         eprint(f"Fetching base revision {base_commit_sha} from GitHub...")
-        run(f"git fetch --no-tags --progress --no-recurse-submodules --depth=1 origin {base_commit_sha}")
-
-    # Generate code for HEAD
-    eprint(f"Creating temporary branch with generated code for the HEAD revision {head_commit_sha}")
-    run(f"git checkout {head_commit_sha} -b {HEAD_BRANCH_NAME}")
-    generate_and_commit_generated_code(head_commit_sha)
-
-    # Generate code for base
-    eprint(f"Creating temporary branch with generated code for the base revision {base_commit_sha}")
-    run(f"git checkout {base_commit_sha} -b {BASE_BRANCH_NAME}")
-    generate_and_commit_generated_code(base_commit_sha)
+        # The fetch can take a while, so its progress is shown as it happens
+        run(f"git fetch --no-tags --progress --no-recurse-submodules --depth=1 origin {base_commit_sha}",
+            buffer_output=False)
+
+    try:
+        # Generate code for HEAD
+        eprint(f"Creating temporary branch with generated code for the HEAD revision {head_commit_sha}")
+        run(f"git checkout {head_commit_sha} -b {HEAD_BRANCH_NAME}")
+        generate_and_commit_generated_code(head_commit_sha)
+
+        # Generate code for base
+        eprint(f"Creating temporary branch with generated code for the base revision {base_commit_sha}")
+        run(f"git checkout {base_commit_sha} -b {BASE_BRANCH_NAME}")
+        # The base revision's generated code doesn't change between local runs against the same base, so it can be
+        # cached in `SMITHY_RS_CODEGEN_CACHE_DIR` when that is set. CI doesn't set it.
+        generate_and_commit_generated_code(base_commit_sha, use_cache=True)
+    finally:
+        stop_gradle_daemon()
 
     bot_message = make_diffs(base_commit_sha, head_commit_sha)
     write_to_file(f"{OUTPUT_PATH}/bot-message", bot_message)
@@ -1,10 +1,16 @@
 #  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 #  SPDX-License-Identifier: Apache-2.0
 
+import contextlib
+import hashlib
+import itertools
 import os
 import shlex
+import shutil
 import subprocess
 import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 HEAD_BRANCH_NAME = "__tmp-localonly-head"
 BASE_BRANCH_NAME = "__tmp-localonly-base"
@@ -15,12 +21,32 @@ COMMIT_AUTHOR_EMAIL = "generated-code-action@github.com"
 
 CDN_URL = "https://d2luzm2xt3nokh.cloudfront.net"
 
+# When set, generated code is cached here, keyed by the revision it was generated from. This is opt-in for local
+# runs that are repeated against the same base revision: CI doesn't set it, and the CI image doesn't have `zstd`.
+CODEGEN_CACHE_DIR = os.environ.get("SMITHY_RS_CODEGEN_CACHE_DIR")
+
 target_codegen_client = 'codegen-client-test'
 target_codegen_server = 'codegen-server-test'
 target_codegen_server_python = 'codegen-server-test:python'
 target_codegen_server_typescript = 'codegen-server-test:typescript'
 target_aws_sdk = 'aws:sdk'
 
+# All of the Gradle invocations in a CI job share a single daemon with a presized heap, so only the first
+# one pays for JVM startup and configuration. In the Docker build, the daemon is stopped once the scripts are done
+# generating code. CI runners should persist `GRADLE_USER_HOME` (`~/.gradle`) between jobs to keep its caches warm.
+# These scripts only ever run codegen tasks, never tests, so the daemon uses the throughput collector.
+GRADLE_JVM_ARGS = "-Xms4g -Xmx8g -XX:+UseParallelGC"
+# Short codegen runs also trade peak JIT performance for faster warmup. The AWS SDK codegen runs for minutes on the
+# same daemon, long enough for the C2 compiler to pay off, so this is left out whenever it is one of the targets.
+GRADLE_SHORT_RUN_JVM_ARGS = "-XX:TieredStopAtLevel=1"
+
+# Read up front since checking out another revision may replace this file
+with open(__file__, "rb") as _file:
+    _DIFF_LIB_SOURCE = _file.read()
+
+# Size of the chunks that `git diff` output is streamed to `difftags` in
+DIFF_CHUNK_SIZE = 64 * 1024
+
 
 def running_in_docker_build():
     return os.environ.get("SMITHY_RS_DOCKER_BUILD_IMAGE") == "1"
@@ -29,15 +55,17 @@ def running_in_docker_build():
 def checkout_commit_and_generate(revision_sha, branch_name, targets=None, preserve_aws_sdk_build=False):
     if running_in_docker_build():
         eprint(f"Fetching base revision {revision_sha} from GitHub...")
-        run(f"git fetch --no-tags --progress --no-recurse-submodules --depth=1 origin {revision_sha}")
+        # The fetch can take a while, so its progress is shown as it happens
+        run(["git", "fetch", "--no-tags", "--progress", "--no-recurse-submodules", "--depth=1", "origin", revision_sha],
+            buffer_output=False)
 
     # Generate code for HEAD
     eprint(f"Creating temporary branch {branch_name} with generated code for {revision_sha}")
-    run(f"git checkout {revision_sha} -B {branch_name}")
+    run(["git", "checkout", revision_sha, "-B", branch_name])
     generate_and_commit_generated_code(revision_sha, targets, preserve_aws_sdk_build)
 
 
-def generate_and_commit_generated_code(revision_sha, targets=None, preserve_aws_sdk_build=False):
+def generate_and_commit_generated_code(revision_sha, targets=None, preserve_aws_sdk_build=False, use_cache=False):
     targets = targets or [
         target_codegen_client,
         target_codegen_server,
@@ -45,83 +73,155 @@ def generate_and_commit_generated_code(revision_sha, targets=None, preserve_aws_
         target_codegen_server_python,
         target_codegen_server_typescript
     ]
+    # The cache only holds the generated code, not the `aws/sdk/build` artifacts
+    cache_path = None
+    if use_cache and CODEGEN_CACHE_DIR and not preserve_aws_sdk_build:
+        cache_path = codegen_cache_path(revision_sha, targets)
+    if cache_path is not None and os.path.exists(cache_path):
+        eprint(f"Restoring generated code for {revision_sha} from {cache_path}")
+        shutil.rmtree(OUTPUT_PATH, ignore_errors=True)
+        os.makedirs(OUTPUT_PATH)
+        run(["tar", "--use-compress-program=zstd", "-xf", cache_path, "-C", OUTPUT_PATH])
+    else:
+        generate_code(targets, preserve_aws_sdk_build)
+        if cache_path is not None:
+            eprint(f"Caching generated code for {revision_sha} in {cache_path}")
+            os.makedirs(CODEGEN_CACHE_DIR, exist_ok=True)
+            # Write to a temporary file first so that an interrupted run never leaves a partial archive behind
+            run(["tar", "--use-compress-program=zstd", "-cf", f"{cache_path}.tmp", "-C", OUTPUT_PATH, "."])
+            os.replace(f"{cache_path}.tmp", cache_path)
+
+    get_cmd_output(["git", "add", "-f", OUTPUT_PATH])
+    if preserve_aws_sdk_build:
+        get_cmd_output(["git", "add", "-f", "aws/sdk/build"])
+
+    get_cmd_output(["git", "commit", "--no-verify", "-m", f"Generated code for {revision_sha}", "--allow-empty"],
+                   env={
+                       **os.environ,
+                       "GIT_AUTHOR_NAME": COMMIT_AUTHOR_NAME,
+                       "GIT_AUTHOR_EMAIL": COMMIT_AUTHOR_EMAIL,
+                       "GIT_COMMITTER_NAME": COMMIT_AUTHOR_NAME,
+                       "GIT_COMMITTER_EMAIL": COMMIT_AUTHOR_EMAIL,
+                   })
+
+
+# Generates code for `targets` into `OUTPUT_PATH`, leaving out the files that shouldn't be diffed
+def generate_code(targets, preserve_aws_sdk_build):
     # Clean the build artifacts before continuing
-    assemble_tasks = ' '.join([f'{t}:assemble' for t in targets])
-    clean_tasks = ' '.join([f'{t}:clean' for t in targets])
-    get_cmd_output("rm -rf aws/sdk/build")
-    get_cmd_output(f"./gradlew --rerun-tasks {clean_tasks}")
-    get_cmd_output(f"./gradlew --rerun-tasks {assemble_tasks}")
+    assemble_tasks = [f'{t}:assemble' for t in targets]
+    clean_tasks = [f'{t}:clean' for t in targets]
+    shutil.rmtree("aws/sdk/build", ignore_errors=True)
+    # Both invocations below use the same JVM arguments so that they share a daemon
+    jvm_args = GRADLE_JVM_ARGS if target_aws_sdk in targets else f"{GRADLE_JVM_ARGS} {GRADLE_SHORT_RUN_JVM_ARGS}"
+    # A single invocation avoids paying Gradle's startup and configuration cost twice
+    gradlew("--parallel", "--rerun-tasks", *clean_tasks, *assemble_tasks, jvm_args=jvm_args)
 
     # Move generated code into codegen-diff/ directory
-    get_cmd_output(f"rm -rf {OUTPUT_PATH}")
-    get_cmd_output(f"mkdir {OUTPUT_PATH}")
+    shutil.rmtree(OUTPUT_PATH, ignore_errors=True)
+    os.makedirs(OUTPUT_PATH)
     if target_aws_sdk in targets:
         # Compiling aws-config for semver checks baseline requires build artifacts to exist under aws/sdk/build
         if preserve_aws_sdk_build:
-            get_cmd_output(f"cp -r aws/sdk/build/aws-sdk {OUTPUT_PATH}/")
+            shutil.copytree("aws/sdk/build/aws-sdk", f"{OUTPUT_PATH}/aws-sdk", symlinks=True)
         else:
-            get_cmd_output(f"mv aws/sdk/build/aws-sdk {OUTPUT_PATH}/")
+            shutil.move("aws/sdk/build/aws-sdk", f"{OUTPUT_PATH}/")
     for target in [target_codegen_client, target_codegen_server]:
         if target in targets:
-            get_cmd_output(f"mv {target}/build/smithyprojections/{target} {OUTPUT_PATH}/")
+            shutil.move(f"{target}/build/smithyprojections/{target}", f"{OUTPUT_PATH}/")
             if target == target_codegen_server:
-                get_cmd_output(f"./gradlew --rerun-tasks {target_codegen_server_python}:stubs")
-                get_cmd_output(f"mv {target}/python/build/smithyprojections/{target}-python {OUTPUT_PATH}/")
-                get_cmd_output(f"mv {target}/typescript/build/smithyprojections/{target}-typescript {OUTPUT_PATH}/")
+                gradlew("--rerun-tasks", f"{target_codegen_server_python}:stubs", jvm_args=jvm_args)
+                shutil.move(f"{target}/python/build/smithyprojections/{target}-python", f"{OUTPUT_PATH}/")
+                shutil.move(f"{target}/typescript/build/smithyprojections/{target}-typescript", f"{OUTPUT_PATH}/")
 
     # Clean up the SDK directory
-    get_cmd_output(f"rm -f {OUTPUT_PATH}/aws-sdk/versions.toml")
+    try:
+        os.unlink(f"{OUTPUT_PATH}/aws-sdk/versions.toml")
+    except FileNotFoundError:
+        pass
 
     # Clean up the client-test folder
-    get_cmd_output(f"rm -rf {OUTPUT_PATH}/codegen-client-test/source")
-    run(f"find {OUTPUT_PATH}/codegen-client-test | "
-        f"grep -E 'smithy-build-info.json|sources/manifest|model.json' | "
-        f"xargs rm -f", shell=True)
+    shutil.rmtree(f"{OUTPUT_PATH}/codegen-client-test/source", ignore_errors=True)
+    remove_build_metadata(f"{OUTPUT_PATH}/codegen-client-test")
 
     # Clean up the server-test folder
-    get_cmd_output(f"rm -rf {OUTPUT_PATH}/codegen-server-test/source")
-    get_cmd_output(f"rm -rf {OUTPUT_PATH}/codegen-server-test-python/source")
-    get_cmd_output(f"rm -rf {OUTPUT_PATH}/codegen-server-test-typescript/source")
-    run(f"find {OUTPUT_PATH}/codegen-server-test | "
-        f"grep -E 'smithy-build-info.json|sources/manifest|model.json' | "
-        f"xargs rm -f", shell=True)
-    run(f"find {OUTPUT_PATH}/codegen-server-test-python | "
-        f"grep -E 'smithy-build-info.json|sources/manifest|model.json' | "
-        f"xargs rm -f", shell=True)
-    run(f"find {OUTPUT_PATH}/codegen-server-test-typescript | "
-        f"grep -E 'smithy-build-info.json|sources/manifest|model.json' | "
-        f"xargs rm -f", shell=True)
-
-    get_cmd_output(f"git add -f {OUTPUT_PATH}")
-    if preserve_aws_sdk_build:
-        get_cmd_output(f"git add -f aws/sdk/build")
-
-    get_cmd_output(f"git -c 'user.name=GitHub Action (generated code preview)' "
-                   f"-c 'user.name={COMMIT_AUTHOR_NAME}' "
-                   f"-c 'user.email={COMMIT_AUTHOR_EMAIL}' "
-                   f"commit --no-verify -m 'Generated code for {revision_sha}' --allow-empty")
+    shutil.rmtree(f"{OUTPUT_PATH}/codegen-server-test/source", ignore_errors=True)
+    shutil.rmtree(f"{OUTPUT_PATH}/codegen-server-test-python/source", ignore_errors=True)
+    shutil.rmtree(f"{OUTPUT_PATH}/codegen-server-test-typescript/source", ignore_errors=True)
+    remove_build_metadata(f"{OUTPUT_PATH}/codegen-server-test")
+    remove_build_metadata(f"{OUTPUT_PATH}/codegen-server-test-python")
+    remove_build_metadata(f"{OUTPUT_PATH}/codegen-server-test-typescript")
+
+
+# Returns the path of the cached generated code for `revision_sha`. The key also covers everything outside of the
+# revision that affects the generated code: the targets, the version commit hash override, and this script.
+def codegen_cache_path(revision_sha, targets):
+    key = hashlib.sha256()
+    key.update(" ".join(targets).encode("utf-8"))
+    key.update(os.environ.get("SMITHY_RS_VERSION_COMMIT_HASH_OVERRIDE", "").encode("utf-8"))
+    key.update(_DIFF_LIB_SOURCE)
+    return os.path.join(CODEGEN_CACHE_DIR, f"smithy-codegen-{revision_sha}-{key.hexdigest()[:8]}.tar.zst")
+
+
+# `./gradlew --stop` stops every daemon of this Gradle version, so this only does anything in the Docker build,
+# where there are no other daemons to stop
+def stop_gradle_daemon():
+    if running_in_docker_build():
+        run(["./gradlew", "--stop"])
+
+
+# Deletes the Smithy build metadata files under `path`, which doesn't exist when its target wasn't generated
+def remove_build_metadata(path):
+    build_metadata = ("smithy-build-info.json", "sources/manifest", "model.json")
+    for (dirpath, _, filenames) in os.walk(path, followlinks=False):
+        for filename in filenames:
+            full_path = os.path.join(dirpath, filename)
+            if full_path.endswith(build_metadata):
+                os.unlink(full_path)
+
+
+# Yields the unified diff of `path_to_diff` between the base and head branches in chunks, so that large diffs
+# never have to be held in memory all at once
+def generate_diff(path_to_diff, whitespace):
+    whitespace_flags = [] if whitespace else ["-b"]
+    # Rename detection is skipped since it's expensive on large SDK diffs
+    command = ["git", "diff", "--no-renames", "-U30", *whitespace_flags,
+               BASE_BRANCH_NAME, HEAD_BRANCH_NAME, "--", path_to_diff]
+    eprint(f"running `{' '.join(command)}`")
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=sys.stderr) as git:
+        for chunk in iter(lambda: git.stdout.read1(DIFF_CHUNK_SIZE), b""):
+            yield chunk
+    if git.returncode != 0:
+        raise subprocess.CalledProcessError(git.returncode, command)
 
 
 def make_diff(title, path_to_diff, base_commit_sha, head_commit_sha, suffix, whitespace):
-    whitespace_flag = "" if whitespace else "-b"
-    diff_exists = get_cmd_status(f"git diff --quiet {whitespace_flag} "
-                                 f"{BASE_BRANCH_NAME} {HEAD_BRANCH_NAME} -- {path_to_diff}")
-    if diff_exists == 0:
+    chunks = generate_diff(path_to_diff, whitespace)
+    # Only the first chunk is needed to tell whether there is a diff at all
+    first_chunk = next(chunks, b"")
+    if not first_chunk:
         eprint(f"No diff output for {base_commit_sha}..{head_commit_sha} ({suffix})")
         return None
     else:
         partial_output_path = f"{base_commit_sha}/{head_commit_sha}/{suffix}"
         full_output_path = f"{OUTPUT_PATH}/{partial_output_path}"
-        run(f"mkdir -p {full_output_path}")
-        run(f"git diff --output=codegen-diff.txt -U30 {whitespace_flag} {BASE_BRANCH_NAME} {HEAD_BRANCH_NAME} -- {path_to_diff}")
+        os.makedirs(full_output_path, exist_ok=True)
 
         # Generate HTML diff. This uses the `difftags` tool from the `tools/` directory.
-        # All arguments after the first `--` go to the `git diff` command.
+        # The diff is streamed to its stdin rather than written to disk and read back.
         whitespace_context = "" if whitespace else "(ignoring whitespace)"
         subtitle = f"rev. {head_commit_sha} {whitespace_context}"
-        diff_cmd = f"difftags --output-dir {full_output_path} --title \"{title}\" --subtitle \"{subtitle}\" codegen-diff.txt"
-        eprint(f"Running diff cmd: {diff_cmd}")
-        run(diff_cmd)
+        diff_cmd = ["difftags", "--output-dir", full_output_path, "--title", title, "--subtitle", subtitle,
+                    "/dev/stdin"]
+        eprint(f"Running diff cmd: {' '.join(diff_cmd)}")
+        with subprocess.Popen(diff_cmd, stdin=subprocess.PIPE, stdout=sys.stderr, stderr=sys.stderr) as difftags:
+            # If `difftags` exits early, writing fails with a broken pipe, and its exit status is checked below
+            with contextlib.suppress(BrokenPipeError):
+                for chunk in itertools.chain([first_chunk], chunks):
+                    difftags.stdin.write(chunk)
+            with contextlib.suppress(BrokenPipeError):
+                difftags.stdin.close()
+        if difftags.returncode != 0:
+            raise subprocess.CalledProcessError(difftags.returncode, diff_cmd)
         return f"{partial_output_path}/index.html"
 
 
@@ -133,26 +233,46 @@ def diff_link(diff_text, empty_diff_text, diff_location, alternate_text, alterna
 
 
 def make_diffs(base_commit_sha, head_commit_sha):
-    sdk_ws = make_diff("AWS SDK", f"{OUTPUT_PATH}/aws-sdk", base_commit_sha,
-                       head_commit_sha, "aws-sdk", whitespace=True)
-    sdk_nows = make_diff("AWS SDK", f"{OUTPUT_PATH}/aws-sdk", base_commit_sha, head_commit_sha,
-                         "aws-sdk-ignore-whitespace", whitespace=False)
-    client_ws = make_diff("Client Test", f"{OUTPUT_PATH}/codegen-client-test", base_commit_sha,
-                          head_commit_sha, "client-test", whitespace=True)
-    client_nows = make_diff("Client Test", f"{OUTPUT_PATH}/codegen-client-test", base_commit_sha,
-                            head_commit_sha, "client-test-ignore-whitespace", whitespace=False)
-    server_ws = make_diff("Server Test", f"{OUTPUT_PATH}/codegen-server-test", base_commit_sha,
-                          head_commit_sha, "server-test", whitespace=True)
-    server_nows = make_diff("Server Test", f"{OUTPUT_PATH}/codegen-server-test", base_commit_sha,
-                            head_commit_sha, "server-test-ignore-whitespace", whitespace=False)
-    server_ws_python = make_diff("Server Test Python", f"{OUTPUT_PATH}/codegen-server-test-python", base_commit_sha,
-                                 head_commit_sha, "server-test-python", whitespace=True)
-    server_nows_python = make_diff("Server Test Python", f"{OUTPUT_PATH}/codegen-server-test-python", base_commit_sha,
-                                   head_commit_sha, "server-test-python-ignore-whitespace", whitespace=False)
-    server_ws_typescript = make_diff("Server Test Typescript", f"{OUTPUT_PATH}/codegen-server-test-typescript", base_commit_sha,
-                                     head_commit_sha, "server-test-typescript", whitespace=True)
-    server_nows_typescript = make_diff("Server Test Typescript", f"{OUTPUT_PATH}/codegen-server-test-typescript", base_commit_sha,
-                                       head_commit_sha, "server-test-typescript-ignore-whitespace", whitespace=False)
+    diffs = [
+        ("AWS SDK", f"{OUTPUT_PATH}/aws-sdk", "aws-sdk", True),
+        ("AWS SDK", f"{OUTPUT_PATH}/aws-sdk", "aws-sdk-ignore-whitespace", False),
+        ("Client Test", f"{OUTPUT_PATH}/codegen-client-test", "client-test", True),
+        ("Client Test", f"{OUTPUT_PATH}/codegen-client-test", "client-test-ignore-whitespace", False),
+        ("Server Test", f"{OUTPUT_PATH}/codegen-server-test", "server-test", True),
+        ("Server Test", f"{OUTPUT_PATH}/codegen-server-test", "server-test-ignore-whitespace", False),
+        ("Server Test Python", f"{OUTPUT_PATH}/codegen-server-test-python", "server-test-python", True),
+        ("Server Test Python", f"{OUTPUT_PATH}/codegen-server-test-python",
+         "server-test-python-ignore-whitespace", False),
+        ("Server Test Typescript", f"{OUTPUT_PATH}/codegen-server-test-typescript", "server-test-typescript", True),
+        ("Server Test Typescript", f"{OUTPUT_PATH}/codegen-server-test-typescript",
+         "server-test-typescript-ignore-whitespace", False),
+    ]
+    # A single walk is enough to tell when none of the generated code changed
+    (status, _, _) = get_cmd_output(["git", "diff", "--quiet", BASE_BRANCH_NAME, HEAD_BRANCH_NAME, "--", OUTPUT_PATH],
+                                    check=False)
+    if status == 0:
+        eprint(f"No diff output for {base_commit_sha}..{head_commit_sha}")
+        locations = {suffix: None for (_, _, suffix, _) in diffs}
+    else:
+        # The diffs are independent of each other and mostly spend their time waiting on `git diff` and `difftags`
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = {
+                suffix: executor.submit(make_diff, title, path, base_commit_sha, head_commit_sha, suffix,
+                                        whitespace=whitespace)
+                for (title, path, suffix, whitespace) in diffs
+            }
+            locations = {suffix: future.result() for (suffix, future) in futures.items()}
+
+    sdk_ws = locations["aws-sdk"]
+    sdk_nows = locations["aws-sdk-ignore-whitespace"]
+    client_ws = locations["client-test"]
+    client_nows = locations["client-test-ignore-whitespace"]
+    server_ws = locations["server-test"]
+    server_nows = locations["server-test-ignore-whitespace"]
+    server_ws_python = locations["server-test-python"]
+    server_nows_python = locations["server-test-python-ignore-whitespace"]
+    server_ws_typescript = locations["server-test-typescript"]
+    server_nows_typescript = locations["server-test-typescript-ignore-whitespace"]
 
     sdk_links = diff_link('AWS SDK', 'No codegen difference in the AWS SDK',
                           sdk_ws, 'ignoring whitespace', sdk_nows)
@@ -183,12 +303,28 @@ def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-# Runs a shell command
-def run(command, shell=False, check=True):
-    eprint(f"running `{command}`")
-    if not shell:
-        command = shlex.split(command)
-    subprocess.run(command, stdout=sys.stderr, stderr=sys.stderr, shell=shell, check=check)
+# Runs a shell command. The command can be a string or an already split list of arguments.
+# Unless `buffer_output` is false, the output is only echoed if the command exits with a non-zero status, even
+# when `check` is false. This avoids slow unbuffered writes to stderr for chatty commands.
+def run(command, shell=False, check=True, buffer_output=True, **kwargs):
+    if isinstance(command, str):
+        eprint(f"running `{command}`")
+        if not shell:
+            command = shlex.split(command)
+    else:
+        eprint(f"running `{' '.join(command)}`")
+    if not buffer_output:
+        subprocess.run(command, stdout=sys.stderr, stderr=sys.stderr, shell=shell, check=check, **kwargs)
+        return
+    with tempfile.TemporaryFile() as log:
+        result = subprocess.run(command, stdout=log, stderr=log, shell=shell, check=False, **kwargs)
+        if result.returncode != 0:
+            log.seek(0)
+            sys.stderr.flush()
+            shutil.copyfileobj(log, sys.stderr.buffer)
+            sys.stderr.buffer.flush()
+            if check:
+                raise subprocess.CalledProcessError(result.returncode, command)
 
 
 # Returns (status, stdout, stderr) from a shell command
@@ -216,6 +352,16 @@ def get_cmd_output(command, cwd=None, check=True, quiet=False, **kwargs):
     return result.returncode, stdout, stderr
 
 
+# Runs a Gradle task through the wrapper on the shared daemon. Returns (status, stdout, stderr) like `get_cmd_output`.
+def gradlew(*args, jvm_args=GRADLE_JVM_ARGS):
+    gradle_opts = " ".join(filter(None, [
+        os.environ.get("GRADLE_OPTS"),
+        "-Dorg.gradle.daemon=true",
+        f"\"-Dorg.gradle.jvmargs={jvm_args}\"",
+    ]))
+    return get_cmd_output(["./gradlew", *args], env={**os.environ, "GRADLE_OPTS": gradle_opts})
+
+
 # Runs a shell command and returns its exit status
 def get_cmd_status(command):
     return subprocess.run(command, capture_output=True, shell=True).returncode
@@ -5,7 +5,7 @@
 import sys
 import os
 from diff_lib import get_cmd_output, get_cmd_status, eprint, running_in_docker_build, checkout_commit_and_generate, \
-    OUTPUT_PATH
+    stop_gradle_daemon, OUTPUT_PATH
 
 
 CURRENT_BRANCH = 'current'
@@ -27,8 +27,12 @@ def main(skip_generation=False):
         sys.exit(1)
 
     if not skip_generation:
-        checkout_commit_and_generate(head_commit_sha, CURRENT_BRANCH, targets=['aws:sdk'])
-        checkout_commit_and_generate(base_commit_sha, BASE_BRANCH, targets=['aws:sdk'], preserve_aws_sdk_build=True)
+        try:
+            checkout_commit_and_generate(head_commit_sha, CURRENT_BRANCH, targets=['aws:sdk'])
+            checkout_commit_and_generate(base_commit_sha, BASE_BRANCH, targets=['aws:sdk'],
+                                         preserve_aws_sdk_build=True)
+        finally:
+            stop_gradle_daemon()
     get_cmd_output(f'git checkout {CURRENT_BRANCH}')
     sdk_directory = os.path.join(OUTPUT_PATH, 'aws-sdk', 'sdk')
     os.chdir(sdk_directory)